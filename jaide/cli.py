@@ -14,15 +14,19 @@ https://github.com/NetworkAutomation/jaide
 """
 from __future__ import print_function
 # standard modules
+import atexit
 import os
 from os import path, popen
-import multiprocessing
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 import re
+import socket
 import sys
 # intra-Jaide imports
+import server
 import wrap
 from utils import clean_lines
-from color_utils import color
+from color_utils import color, strip_color
 # non-standard modules:
 import click
 
@@ -30,25 +34,120 @@ import click
 
 # needed for '-h' to be a help option
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+# default upper limit on the number of devices we will talk to at the same
+# time. Can be overridden with the JAIDE_MAX_CONCURRENCY environment variable.
+MAX_WORKERS = 32
+# the most finished devices to write out together, see _batches().
+WRITE_BATCH = 16
+# the shared worker pool, created the first time a command needs it, and
+# how many worker threads it has.
+_POOL = None
+_POOL_SIZE = 0
+# open output files for -w in single file mode, keyed by filepath. See
+# write_out().
+_OUT_FILES = {}
+# matches the commit --at time, either 'hh:mm[:ss]' or 'yyyy-mm-dd hh:mm[:ss]'
+_AT_TIME_RE = re.compile(r'\A(?:\d{4}-[01]\d-[0-3]\d )?'
+                         r'[0-2]\d:[0-5]\d(?::[0-5]\d)?\Z')
+# commands that never connect to a device, so don't need -i, -u, or -p.
+NO_CONNECT_COMMANDS = frozenset(['serve'])
+# valid modes for the -w option, and those writing a file per device.
+WRITE_MODES = frozenset(['s', 'single', 'm', 'multiple'])
+MULTI_MODES = frozenset(['m', 'multiple'])
 
 
 class AliasedGroup(click.Group):
 
     """ Extends click.Group to allow for partial commands. """
 
+    def __init__(self, *args, **kwargs):
+        click.Group.__init__(self, *args, **kwargs)
+        # maps every prefix of every command to its full name, or to None if
+        # the prefix is shared by more than one command. Built on first use.
+        self._prefix_cache = None
+
+    def add_command(self, cmd, name=None):
+        """ Invalidate the prefix cache when a command is added. """
+        click.Group.add_command(self, cmd, name)
+        self._prefix_cache = None
+
     def get_command(self, ctx, cmd_name):
         """ Allow for partial commands. """
         rv = click.Group.get_command(self, ctx, cmd_name)
         if rv is not None:
             return rv
-        matches = [x for x in self.list_commands(ctx)
-                   if x.startswith(cmd_name)]
-        if not matches:
+        if self._prefix_cache is None:
+            self._prefix_cache = {}
+            for name in self.list_commands(ctx):
+                for i in range(1, len(name) + 1):
+                    prefix = name[:i]
+                    self._prefix_cache[prefix] = (
+                        None if prefix in self._prefix_cache else name)
+        if cmd_name not in self._prefix_cache:
             return None
-        elif len(matches) == 1:
-            return click.Group.get_command(self, ctx, matches[0])
+        full_name = self._prefix_cache[cmd_name]
+        if full_name is not None:
+            return click.Group.get_command(self, ctx, full_name)
         ctx.fail('Command ambiguous, could be: %s' %
-                 ', '.join(sorted(matches)))
+                 ', '.join(sorted(x for x in self.list_commands(ctx)
+                                  if x.startswith(cmd_name))))
+
+    def parse_args(self, ctx, args):
+        """ Skip the connection prompts when nothing will be connected to.
+
+        That is the case for commands that don't touch a device, and for
+        any invocation asking for help or the version, either of jaide
+        itself or of the subcommand (ex. 'jaide commit --help').
+        """
+        # the group's own options have to be parsed first to find the
+        # subcommand, since they can come before it (ex. 'jaide -P 22 serve').
+        opts, rest = _probe_args(self, ctx.parent, ctx.info_name, args)
+        info_only = bool(opts.get('help') or opts.get('version'))
+        cmd = None
+        if rest:
+            cmd = self.get_command(ctx, rest[0])
+        if cmd is not None and not info_only:
+            info_only = bool(_probe_args(cmd, ctx, rest[0],
+                                         rest[1:])[0].get('help'))
+        ctx.skip_prompts = info_only or (cmd is not None and
+                                         cmd.name in NO_CONNECT_COMMANDS)
+        return click.Group.parse_args(self, ctx, args)
+
+
+def _probe_args(cmd, parent, info_name, args):
+    """ Parse the options of a command, without acting on any of them.
+
+    Purpose: Parsing is done on a resilient throwaway context, so that no
+           | callbacks are run and any errors are left for the real parse
+           | to report.
+
+    @param cmd: The click command or group whose options to parse.
+    @type cmd: click.Command
+    @param parent: The parent context of the command, if any.
+    @type parent: click.Context
+    @param info_name: The name the command was invoked as.
+    @type info_name: str
+    @param args: The command line arguments for the command.
+    @type args: list
+
+    @returns: The dictionary of parsed option values, keyed by option name,
+            | and the list of leftover arguments.
+    @rtype: tuple
+    """
+    probe = click.Context(cmd, parent=parent, info_name=info_name,
+                          resilient_parsing=True, **cmd.context_settings)
+    return tuple(cmd.make_parser(probe).parse_args(args=list(args))[:2])
+
+
+class ConnectionOption(click.Option):
+
+    """ Extends click.Option to only prompt when connecting to a device. """
+
+    def full_process_value(self, ctx, value):
+        """ Leave the value unset instead of prompting, if flagged to. """
+        if value is None and getattr(ctx, 'skip_prompts', False):
+            return None
+        return click.Option.full_process_value(self, ctx, value)
 
 
 def at_time_validate(ctx, param, value):
@@ -75,9 +174,7 @@ def at_time_validate(ctx, param, value):
     """
     # if they are doing commit_at, ensure the input is formatted correctly.
     if value is not None:
-        if (re.search(r'([0-2]\d)(:[0-5]\d){1,2}', value) is None and
-            re.search(r'\d{4}-[01]\d-[0-3]\d [0-2]\d:[0-5]\d(:[0-5]\d)?',
-                      value) is None):
+        if _AT_TIME_RE.match(value) is None:
             raise click.BadParameter("A commit at time must be in one of the "
                                      "two formats: 'hh:mm[:ss]' or "
                                      "'yyyy-mm-dd hh:mm[:ss]' (seconds are "
@@ -123,7 +220,7 @@ def write_validate(ctx, param, value):
                                      'output (s, single, m, multiple), and '
                                      'the second is a filepath where to put'
                                      ' the output.')
-        if mode.lower() not in ['s', 'single', 'm', 'multiple']:
+        if mode.lower() not in WRITE_MODES:
             raise click.BadParameter('The first argument of the -w/--write '
                                      'option must specifies whether to write'
                                      ' to one file per device, or all device'
@@ -139,9 +236,10 @@ def write_validate(ctx, param, value):
 def write_out(input):
     """ Callback function to write the output from the script.
 
-    @param input: A tuple containing two things:
+    @param input: A tuple containing three things:
                 | 1. None or Tuple of file mode and destination filepath
-                | 2. The output of the jaide command that will be either
+                | 2. The IP or hostname of the device the output is from.
+                | 3. The output of the jaide command that will be either
                 |    written to sys.stdout or to a file, depending on the
                 |    first index in the tuple.
                 |
@@ -155,7 +253,7 @@ def write_out(input):
     @returns: None
     """
     # peel off the to_file metadata from the output.
-    to_file, output = input
+    to_file, ip, output = input
     if to_file != "quiet":
         try:
             # split the to_file metadata into it's separate parts.
@@ -165,14 +263,22 @@ def write_out(input):
             # the metadata.
             click.echo(output)
         else:
-            ip = output.split('device: ')[1].split('\n')[0].strip()
-            if mode in ['m', 'multiple']:
+            if mode in MULTI_MODES:
                 # put the IP in front of the filename if we're writing each
                 # device to its own file.
-                dest_file = path.join(path.split(dest_file)[0], ip + "_" +
-                                      path.split(dest_file)[1])
+                head, tail = path.split(dest_file)
+                dest_file = path.join(head, ip + "_" + tail)
             try:
-                out_file = open(dest_file, 'a+b')
+                if mode in MULTI_MODES:
+                    # each device's file is only written once, so it is
+                    # closed again below rather than held open.
+                    out_file = open(dest_file, 'ab')
+                else:
+                    # keep the file open for the other devices writing to it.
+                    out_file = _OUT_FILES.get(dest_file)
+                    if out_file is None:
+                        out_file = _OUT_FILES[dest_file] = open(
+                            dest_file, 'ab', 64 * 1024)
             except IOError as e:
                 print(color("Could not open output file '%s' for writing. "
                             "Output would have been:\n%s" %
@@ -180,9 +286,197 @@ def write_out(input):
                 print(color('Here is the error for opening the output file:' +
                             str(e), 'red'))
             else:
-                click.echo(output, nl=False, file=out_file)
+                out_file.write(strip_color(output))
+                if mode in MULTI_MODES:
+                    out_file.close()
                 print(color('%s output appended to: %s' % (ip, dest_file)))
-                out_file.close()
+
+
+def _close_out_files():
+    """ Flush and close any output files opened by write_out(). """
+    while _OUT_FILES:
+        _OUT_FILES.popitem()[1].close()
+
+
+atexit.register(_close_out_files)
+
+
+def _parse_hosts(host):
+    """ Build the tuple of devices to connect to from the -i option.
+
+    Purpose: Accepts the same input as jaide.utils.clean_lines(): a single
+           | IP/hostname, a comma separated list of them, or a filepath to a
+           | file listing them on individual lines. Blank lines and lines
+           | starting with '#' are skipped. A host file is read in one go.
+
+    @param host: The value supplied for the -i option.
+    @type host: str
+
+    @returns: The stripped IPs/hostnames, in order.
+    @rtype: tuple
+    """
+    if path.isfile(host):
+        with open(host, 'rb') as host_file:
+            lines = host_file.read().splitlines()
+    else:
+        lines = host.split(',')
+    return tuple(line.strip() for line in lines
+                 if line.strip() and not line.strip().startswith('#'))
+
+
+def _expand_commands(commands):
+    """ Read a command file once, instead of once for every device.
+
+    @param commands: The commands argument given to a command. If it is a
+                   | filepath, the file is read with clean_lines().
+                   | Anything else is returned untouched, and is left for
+                   | the jaide.wrap function to break up.
+    @type commands: str or list
+
+    @returns: The list of commands from the file, or commands unchanged.
+    @rtype: list or str
+    """
+    if isinstance(commands, basestring) and path.isfile(commands):
+        return list(clean_lines(commands))
+    return commands
+
+
+def _max_workers():
+    """ Read the limit on devices worked at once from the environment.
+
+    @returns: The JAIDE_MAX_CONCURRENCY environment variable if it is set,
+            | otherwise MAX_WORKERS. Raises click.UsageError if it is set to
+            | anything other than a whole number above 0.
+    @rtype: int
+    """
+    try:
+        limit = int(os.environ.get('JAIDE_MAX_CONCURRENCY', MAX_WORKERS))
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        raise click.UsageError('The JAIDE_MAX_CONCURRENCY environment '
+                               'variable must be a whole number above 0.')
+    return limit
+
+
+def _get_pool(size, limit):
+    """ Return the shared worker pool, creating or resizing it as needed.
+
+    Purpose: Talking to Junos devices is almost entirely spent waiting on
+           | SSH/NETCONF sockets, so a pool of threads is used instead of
+           | forking processes. The pool is created lazily and reused, and
+           | is only rebuilt when more workers are needed than it has, or
+           | when it has more than limit allows.
+
+    @param size: The number of workers desired, usually the number of
+               | devices.
+    @type size: int
+    @param limit: The most workers to use, from _max_workers().
+    @type limit: int
+
+    @returns: The shared thread pool.
+    @rtype: multiprocessing.pool.ThreadPool
+    """
+    global _POOL, _POOL_SIZE
+    size = max(1, min(size, limit))
+    if _POOL is None or _POOL_SIZE < size or _POOL_SIZE > limit:
+        if _POOL is not None:
+            _POOL.close()
+            _POOL.join()
+        _POOL, _POOL_SIZE = ThreadPool(size), size
+    return _POOL
+
+
+def _open_connection(task):
+    """ Call wrap.open_connection() for one device's task from _dispatch().
+
+    @param task: A tuple of the device IP or hostname, the write metadata,
+               | and the tuple of arguments for wrap.open_connection().
+    @type task: tuple
+
+    @returns: The (write, ip, output) tuple from wrap.open_connection().
+    @rtype: tuple
+    """
+    ip, write, args = task
+    try:
+        return wrap.open_connection(*args)
+    except Exception as e:
+        # open_connection() already handles the expected connection errors,
+        # so report anything else rather than losing this device's output.
+        output = color('=' * 50 + '\nResults from device: %s\n\n' % ip, 'yel')
+        output += color('Unexpected error on device %s: %s' % (ip, str(e)),
+                        'red')
+        return write, ip, output
+
+
+def _batches(results, size):
+    """ Group results from the pool into batches of those already finished.
+
+    Purpose: Blocks until at least one more result is ready, then takes
+           | any others that have finished in the meantime, up to size, so
+           | that they can be written out together.
+
+    @param results: The iterator returned by the pool's imap_unordered().
+    @type results: multiprocessing.pool.IMapUnorderedIterator
+    @param size: The most results to put in one batch.
+    @type size: int
+
+    @returns: Yields lists of results, in the order they finished.
+    @rtype: iterable of list
+    """
+    for result in results:
+        batch = [result]
+        while len(batch) < size:
+            try:
+                batch.append(results.next(timeout=0))
+            except (TimeoutError, StopIteration):
+                break
+        yield batch
+
+
+def _dispatch(ctx, function, args):
+    """ Run a jaide.wrap function against every device in parallel.
+
+    @param ctx: The click context paramter, for receiving the object dictionary
+              | being manipulated by other previous functions.
+    @type ctx: click.Context
+    @param function: The downstream jaide.wrap function to run once the
+                   | connection to each device is established.
+    @type function: function pointer.
+    @param args: The arguments to hand off to the downstream function.
+    @type args: list
+
+    @returns: None
+    """
+    if '_base_args' not in ctx.obj:
+        raise click.UsageError('No device connection details were given. Use'
+                               ' the -i, -u and -p options.')
+    # lists rather than tuples if they came through 'jaide serve'.
+    base = tuple(ctx.obj['_base_args'])
+    tail = tuple(ctx.obj['_tail_args']) + (ctx.obj.get('pool'),)
+    # tasks are generated as the pool takes them, rather than all up front.
+    tasks = ((ip, tail[0], (ip,) + base + (function, args) + tail)
+             for ip in ctx.obj['hosts'])
+    if len(ctx.obj['hosts']) == 1:
+        # a single device is run right here, without touching the pool.
+        batches = ([_open_connection(task)] for task in tasks)
+    else:
+        workers = _get_pool(len(ctx.obj['hosts']), ctx.obj['max_workers'])
+        batches = _batches(workers.imap_unordered(_open_connection, tasks),
+                           WRITE_BATCH)
+    try:
+        for batch in batches:
+            # terminal output for the whole batch goes out in a single write.
+            echoes = []
+            for result in batch:
+                if result[0] is None:
+                    echoes.append(result[2] + '\n')
+                else:
+                    write_out(result)
+            if echoes:
+                click.echo(''.join(echoes), nl=False)
+    finally:
+        _close_out_files()
 
 
 @click.group(cls=AliasedGroup, context_settings=CONTEXT_SETTINGS,
@@ -192,10 +486,12 @@ def write_out(input):
              "containing IP/hostnames on each line is given for the IP option,"
              " the commands will be sent simultaneously to each device.")
 @click.option('-i', '--ip', 'host', prompt="IP or hostname of Junos device",
+              cls=ConnectionOption,
               help="The target hostname(s) or IP(s). Can be a comma separated"
               " list, or path to a file listing devices on individual lines.")
-@click.option('-u', '--username', prompt="Username")
-@click.password_option('-p', '--password', prompt="Password")
+@click.option('-u', '--username', prompt="Username", cls=ConnectionOption)
+@click.password_option('-p', '--password', prompt="Password",
+                       cls=ConnectionOption)
 @click.option('-P', '--port', default=22, help="The port to connect to. "
               "Defaults to SSH (22)")
 @click.option('--quiet/--no-quiet', default=False, help="Boolean flag to show"
@@ -257,18 +553,47 @@ def main(ctx, host, password, port, quiet, session_timeout, connect_timeout,
             | 'main' do not return anything. Click handles passing context
             | between the functions and maintaing command order and chaining.
     """
+    # commands such as 'serve', or asking for a subcommand's help, don't touch
+    # a device, so there's nothing to do.
+    if ctx.skip_prompts:
+        return
     # build the list of hosts
-    ctx.obj['hosts'] = [ip for ip in clean_lines(host)]
-    # set the connection parameters
-    ctx.obj['conn'] = {
-        "username": username,
-        "password": password,
-        "port": port,
-        "session_timeout": session_timeout,
-        "connect_timeout": connect_timeout
-    }
+    ctx.obj['hosts'] = _parse_hosts(host)
+    # read here rather than in _dispatch(), so that the limit set where jaide
+    # is run also travels with any command handed off to 'jaide serve'.
+    ctx.obj['max_workers'] = _max_workers()
     if quiet:
         ctx.obj['out'] = "quiet"
+    # the wrap.open_connection arguments shared by every device, in order.
+    ctx.obj['_base_args'] = (username, password)
+    ctx.obj['_tail_args'] = (ctx.obj['out'], connect_timeout,
+                             session_timeout, port)
+    # hand the command off to a running 'jaide serve' daemon if asked to.
+    if os.environ.get('JAIDE_DAEMON') == '1':
+        sock_path = server.socket_path()
+        request = {
+            "command": ctx.invoked_subcommand,
+            "args": ctx.args[1:],
+            "obj": ctx.obj,
+            "cwd": os.getcwd(),
+            "tty": sys.stdout.isatty()
+        }
+        try:
+            client = server.connect(sock_path)
+        except socket.error as e:
+            click.echo(color('Could not reach the jaide daemon at %s, running'
+                             ' locally instead. Error: %s' %
+                             (sock_path, str(e)), 'red'), err=True)
+        else:
+            # once sent, the command may already have run on the devices, so
+            # a lost connection is reported instead of running it again.
+            try:
+                status = server.forward(request, client, sys.stdout)
+            except socket.error as e:
+                raise click.ClickException('Lost the connection to the jaide '
+                                           'daemon at %s: %s' %
+                                           (sock_path, str(e)))
+            ctx.exit(status)
 
 
 @main.command(context_settings=CONTEXT_SETTINGS, help="Execute a commit "
@@ -350,20 +675,9 @@ def commit(ctx, commands, blank, check, sync, comment, confirm, at_time):
     if not blank and commands == 'annotate system ""':
         raise click.BadParameter("--blank and the commands argument cannot"
                                  " both be omitted.")
-    mp_pool = multiprocessing.Pool(multiprocessing.cpu_count() * 2)
-    for ip in ctx.obj['hosts']:
-        mp_pool.apply_async(wrap.open_connection, args=(ip,
-                            ctx.obj['conn']['username'],
-                            ctx.obj['conn']['password'],
-                            wrap.commit,
-                            [commands, check, sync, comment, confirm,
-                             ctx.obj['at_time'], blank],
-                            ctx.obj['out'],
-                            ctx.obj['conn']['connect_timeout'],
-                            ctx.obj['conn']['session_timeout'],
-                            ctx.obj['conn']['port']), callback=write_out)
-    mp_pool.close()
-    mp_pool.join()
+    commands = _expand_commands(commands)
+    _dispatch(ctx, wrap.commit, [commands, check, sync, comment, confirm,
+                                 ctx.obj['at_time'], blank])
 
 
 @main.command(context_settings=CONTEXT_SETTINGS, help="Compare commands"
@@ -394,18 +708,8 @@ def compare(ctx, commands):
             | 'main' do not return anything. Click handles passing context
             | between the functions and maintaing command order and chaining.
     """
-    mp_pool = multiprocessing.Pool(multiprocessing.cpu_count() * 2)
-    for ip in ctx.obj['hosts']:
-        mp_pool.apply_async(wrap.open_connection, args=(ip,
-                            ctx.obj['conn']['username'],
-                            ctx.obj['conn']['password'],
-                            wrap.compare, [commands],
-                            ctx.obj['out'],
-                            ctx.obj['conn']['connect_timeout'],
-                            ctx.obj['conn']['session_timeout'],
-                            ctx.obj['conn']['port']), callback=write_out)
-    mp_pool.close()
-    mp_pool.join()
+    commands = _expand_commands(commands)
+    _dispatch(ctx, wrap.compare, [commands])
 
 
 @main.command(context_settings=CONTEXT_SETTINGS, help="Copy file(s) from "
@@ -413,7 +717,7 @@ def compare(ctx, commands):
               ", or a directory containing many files. If you run into "
               "permissions errors, try using the root account.")
 @click.argument('source', type=click.Path())
-@click.argument('destination', type=click.Path(resolve_path=True))
+@click.argument('destination', type=click.Path())
 @click.option('--progress/--no-progress', default=False, help="Flag to show "
               "progress as the transfer happens. Defaults to False for "
               "multiple devices, as output will be jumbled.")
@@ -438,26 +742,17 @@ def pull(ctx, source, destination, progress):
             | 'main' do not return anything. Click handles passing context
             | between the functions and maintaing command order and chaining.
     """
-    mp_pool = multiprocessing.Pool(multiprocessing.cpu_count() * 2)
     multi = True if len(ctx.obj['hosts']) > 1 else False
-    for ip in ctx.obj['hosts']:
-        mp_pool.apply_async(wrap.open_connection, args=(ip,
-                            ctx.obj['conn']['username'],
-                            ctx.obj['conn']['password'],
-                            wrap.pull, [source, destination, progress, multi],
-                            ctx.obj['out'],
-                            ctx.obj['conn']['connect_timeout'],
-                            ctx.obj['conn']['session_timeout'],
-                            ctx.obj['conn']['port']), callback=write_out)
-    mp_pool.close()
-    mp_pool.join()
+    # resolved here rather than by click, so only when a command is run.
+    destination = path.realpath(destination)
+    _dispatch(ctx, wrap.pull, [source, destination, progress, multi])
 
 
 @main.command(context_settings=CONTEXT_SETTINGS, help="Copy file(s) from "
               "local machine -> device(s).\n\nThe source can be a single file"
               ", or a directory containing many files. If you run into "
               "permissions errors, try using the root account.")
-@click.argument('source', type=click.Path(exists=True, resolve_path=True))
+@click.argument('source', type=click.Path(exists=True))
 @click.argument('destination', type=click.Path())
 @click.option('--progress/--no-progress', default=False, help="Flag to show "
               "progress as the transfer happens. Defaults to False for "
@@ -483,18 +778,9 @@ def push(ctx, source, destination, progress):
             | 'main' do not return anything. Click handles passing context
             | between the functions and maintaing command order and chaining.
     """
-    mp_pool = multiprocessing.Pool(multiprocessing.cpu_count() * 2)
-    for ip in ctx.obj['hosts']:
-        mp_pool.apply_async(wrap.open_connection, args=(ip,
-                            ctx.obj['conn']['username'],
-                            ctx.obj['conn']['password'],
-                            wrap.push, [source, destination, progress],
-                            ctx.obj['out'],
-                            ctx.obj['conn']['connect_timeout'],
-                            ctx.obj['conn']['session_timeout'],
-                            ctx.obj['conn']['port']), callback=write_out)
-    mp_pool.close()
-    mp_pool.join()
+    # resolved here rather than by click, so only when a command is run.
+    source = path.realpath(source)
+    _dispatch(ctx, wrap.push, [source, destination, progress])
 
 
 @main.command(context_settings=CONTEXT_SETTINGS, help="Execute operational "
@@ -540,18 +826,8 @@ def operational(ctx, commands, format, xpath):
             | 'main' do not return anything. Click handles passing context
             | between the functions and maintaing command order and chaining.
     """
-    mp_pool = multiprocessing.Pool(multiprocessing.cpu_count() * 2)
-    for ip in ctx.obj['hosts']:
-        mp_pool.apply_async(wrap.open_connection, args=(ip,
-                            ctx.obj['conn']['username'],
-                            ctx.obj['conn']['password'],
-                            wrap.command, [commands, format, xpath],
-                            ctx.obj['out'],
-                            ctx.obj['conn']['connect_timeout'],
-                            ctx.obj['conn']['session_timeout'],
-                            ctx.obj['conn']['port']), callback=write_out)
-    mp_pool.close()
-    mp_pool.join()
+    commands = _expand_commands(commands)
+    _dispatch(ctx, wrap.command, [commands, format, xpath])
 
 
 @main.command(name='info', context_settings=CONTEXT_SETTINGS, help="Get basic"
@@ -565,18 +841,7 @@ def device_info(ctx):
               | function with the @click.pass_context decorator.
     @type ctx: click.Context
     """
-    mp_pool = multiprocessing.Pool(multiprocessing.cpu_count() * 2)
-    for ip in ctx.obj['hosts']:
-        mp_pool.apply_async(wrap.open_connection, args=(ip,
-                            ctx.obj['conn']['username'],
-                            ctx.obj['conn']['password'],
-                            wrap.device_info, [],
-                            ctx.obj['out'],
-                            ctx.obj['conn']['connect_timeout'],
-                            ctx.obj['conn']['session_timeout'],
-                            ctx.obj['conn']['port']), callback=write_out)
-    mp_pool.close()
-    mp_pool.join()
+    _dispatch(ctx, wrap.device_info, [])
 
 
 @main.command(context_settings=CONTEXT_SETTINGS, help="Compare the "
@@ -607,18 +872,7 @@ def diff_config(ctx, second_host, mode):
             | 'main' do not return anything. Click handles passing context
             | between the functions and maintaing command order and chaining.
     """
-    mp_pool = multiprocessing.Pool(multiprocessing.cpu_count() * 2)
-    for ip in ctx.obj['hosts']:
-        mp_pool.apply_async(wrap.open_connection, args=(ip,
-                            ctx.obj['conn']['username'],
-                            ctx.obj['conn']['password'],
-                            wrap.diff_config, [second_host, mode],
-                            ctx.obj['out'],
-                            ctx.obj['conn']['connect_timeout'],
-                            ctx.obj['conn']['session_timeout'],
-                            ctx.obj['conn']['port']), callback=write_out)
-    mp_pool.close()
-    mp_pool.join()
+    _dispatch(ctx, wrap.diff_config, [second_host, mode])
 
 
 @main.command(name="health", context_settings=CONTEXT_SETTINGS, help="Get "
@@ -636,18 +890,7 @@ def health_check(ctx):
             | 'main' do not return anything. Click handles passing context
             | between the functions and maintaing command order and chaining.
     """
-    mp_pool = multiprocessing.Pool(multiprocessing.cpu_count() * 2)
-    for ip in ctx.obj['hosts']:
-        mp_pool.apply_async(wrap.open_connection, args=(ip,
-                            ctx.obj['conn']['username'],
-                            ctx.obj['conn']['password'],
-                            wrap.health_check, [],
-                            ctx.obj['out'],
-                            ctx.obj['conn']['connect_timeout'],
-                            ctx.obj['conn']['session_timeout'],
-                            ctx.obj['conn']['port']), callback=write_out)
-    mp_pool.close()
-    mp_pool.join()
+    _dispatch(ctx, wrap.health_check, [])
 
 
 @main.command(name="errors", context_settings=CONTEXT_SETTINGS, help="Get any"
@@ -665,18 +908,7 @@ def interface_errors(ctx):
             | 'main' do not return anything. Click handles passing context
             | between the functions and maintaing command order and chaining.
     """
-    mp_pool = multiprocessing.Pool(multiprocessing.cpu_count() * 2)
-    for ip in ctx.obj['hosts']:
-        mp_pool.apply_async(wrap.open_connection, args=(ip,
-                            ctx.obj['conn']['username'],
-                            ctx.obj['conn']['password'],
-                            wrap.interface_errors, [],
-                            ctx.obj['out'],
-                            ctx.obj['conn']['connect_timeout'],
-                            ctx.obj['conn']['session_timeout'],
-                            ctx.obj['conn']['port']), callback=write_out)
-    mp_pool.close()
-    mp_pool.join()
+    _dispatch(ctx, wrap.interface_errors, [])
 
 
 @main.command(context_settings=CONTEXT_SETTINGS, help="Send shell commands to "
@@ -705,18 +937,104 @@ def shell(ctx, commands):
             | 'main' do not return anything. Click handles passing context
             | between the functions and maintaing command order and chaining.
     """
-    mp_pool = multiprocessing.Pool(multiprocessing.cpu_count() * 2)
-    for ip in ctx.obj['hosts']:
-        mp_pool.apply_async(wrap.open_connection, args=(ip,
-                            ctx.obj['conn']['username'],
-                            ctx.obj['conn']['password'],
-                            wrap.shell, [commands],
-                            ctx.obj['out'],
-                            ctx.obj['conn']['connect_timeout'],
-                            ctx.obj['conn']['session_timeout'],
-                            ctx.obj['conn']['port']), callback=write_out)
-    mp_pool.close()
-    mp_pool.join()
+    commands = _expand_commands(commands)
+    _dispatch(ctx, wrap.shell, [commands])
+
+
+@main.command(context_settings=CONTEXT_SETTINGS, help="Keep device sessions "
+              "open between commands.\n\nRuns a local daemon listening on a "
+              "Unix domain socket, set by the JAIDE_SOCKET environment "
+              "variable (defaults to ~/.jaide.sock). Any other jaide command "
+              "run with JAIDE_DAEMON=1 set is handed off to the daemon, which "
+              "reuses its open sessions to each device instead of connecting"
+              " again.")
+@click.option('--idle-timeout', type=click.IntRange(10, 86400), default=300,
+              help="Close a session after it has been unused for this many "
+              "seconds. Defaults to 300 seconds.")
+@click.option('--max-age', type=click.IntRange(60, 86400), default=3600,
+              help="Close a session after it has been open for this many "
+              "seconds, even if it is in use. Defaults to 3600 seconds.")
+@click.pass_context
+def serve(ctx, idle_timeout, max_age):
+    """ Run the session daemon.
+
+    @param ctx: The click context paramter, for receiving the object dictionary
+              | being manipulated by other previous functions. Needed by any
+              | function with the @click.pass_context decorator.
+    @type ctx: click.Context
+    @param idle_timeout: Seconds a session may go unused before it is closed.
+    @type idle_timeout: int
+    @param max_age: Seconds a session may stay open in total before it is
+                  | closed.
+    @type max_age: int
+
+    @returns: None. Functions part of click relating to the command group
+            | 'main' do not return anything. Click handles passing context
+            | between the functions and maintaing command order and chaining.
+    """
+    if os.name != 'posix':
+        raise click.UsageError('The jaide daemon requires Unix domain sockets,'
+                               ' which are not available on this platform.')
+    sock_path = server.socket_path()
+    pool = server.SessionPool(idle_timeout, max_age)
+    pool.start_reaper()
+    click.echo(color('Serving jaide sessions on %s, press Ctrl-C to stop.' %
+                     sock_path, 'yel'))
+    try:
+        server.serve(lambda request, out: _serve_request(pool, request, out),
+                     sock_path)
+    except socket.error as e:
+        raise click.ClickException(str(e))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.close_all()
+
+
+def _serve_request(pool, request, out):
+    """ Run a command forwarded to the 'serve' daemon.
+
+    Purpose: Rebuilds the click context from the request sent by main(),
+           | with the daemon's session pool added to it, then parses and
+           | invokes the subcommand as if it were run locally. Everything
+           | the command prints is sent back to the client, and the
+           | client's working directory is used for any relative paths.
+
+    @param pool: The daemon's pool of open sessions.
+    @type pool: jaide.server.SessionPool
+    @param request: The request dictionary sent by main().
+    @type request: dict
+    @param out: File-like object for sending output back to the client.
+    @type out: file
+
+    @returns: The exit status the command would have had if run locally.
+    @rtype: int
+    """
+    status = 0
+    stdout, stderr, cwd = sys.stdout, sys.stderr, os.getcwd()
+    sys.stdout = sys.stderr = out
+    try:
+        os.chdir(request['cwd'])
+        obj = dict(request['obj'], pool=pool)
+        with click.Context(main, info_name='jaide', obj=obj) as ctx:
+            name, cmd, args = main.resolve_command(
+                ctx, [request['command']] + request['args'])
+            ctx.invoked_subcommand = name
+            with cmd.make_context(name, args, parent=ctx) as sub_ctx:
+                cmd.invoke(sub_ctx)
+    except click.ClickException as e:
+        e.show(file=out)
+        status = e.exit_code
+    except click.Abort:
+        status = 1
+    except SystemExit as e:
+        # ctx.exit(), for example from '--help' on the subcommand.
+        if e.code is not None:
+            status = e.code if isinstance(e.code, int) else 1
+    finally:
+        os.chdir(cwd)
+        sys.stdout, sys.stderr = stdout, stderr
+    return status
 
 
 def run():
@@ -2,6 +2,10 @@
 from colorama import Fore, init, Style
 import re
 
+# init() wraps sys.stdout again every time it is called, which isn't safe
+# from the CLI tool's worker threads, so it is only done once, here.
+init()
+
 
 def color(out_string, color='grn'):
     """ Highlight string for terminal color coding.
@@ -32,7 +36,6 @@ def color(out_string, color='grn'):
         'yel': Fore.YELLOW,
     }
     try:
-        init()
         return (c[color] + Style.BRIGHT + out_string + Fore.RESET + Style.NORMAL)
     except AttributeError:
         return out_string
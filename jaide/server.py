@@ -0,0 +1,391 @@
+""" Jaide session daemon for reusing device connections.
+
+This module backs the 'jaide serve' command of the CLI tool. It keeps Jaide
+sessions to devices open between CLI invocations, keyed by (host, port,
+username), so that follow-on commands against the same devices skip the SSH
+handshake and authentication.
+
+The daemon listens on a local Unix domain socket. When JAIDE_DAEMON=1 is set
+in the environment, the jaide CLI tool forwards its already parsed command
+line to the daemon as a single line of JSON, and streams back the output,
+followed by the command's exit status.
+
+For expansive information on the Jaide class and the Jaide CLI tool,
+refer to the readme file or the associated examples/documentation. More
+information can be found at the github page:
+
+https://github.com/NetworkAutomation/jaide
+"""
+# standard modules
+import json
+import os
+from os import path
+import signal
+import socket
+import SocketServer
+import sys
+import threading
+import time
+# intra-Jaide imports
+from core import Jaide
+# The rest are non-standard modules:
+from ncclient import manager
+from ncclient.transport.errors import TransportError
+import paramiko
+
+# Errors that mean a session broke while a command was running on it. The
+# session is thrown away, but the command is not run again, since it may
+# already have made changes on the device.
+BROKEN_ERRORS = (EOFError, socket.error, paramiko.SSHException,
+                 TransportError)
+# marks the start of the exit status sent after a command's output.
+STATUS_MARK = '\0'
+
+
+def _is_alive(conn):
+    """ Check whether the connections held by a Jaide object are still up.
+
+    Purpose: Only the local state of the transports is looked at, so
+           | nothing is sent to the device. A Jaide object that hasn't
+           | connected at all yet counts as alive, since it will connect
+           | when it is first used.
+
+    @param conn: The pooled Jaide object to check.
+    @type conn: jaide.Jaide object
+
+    @returns: False if any of its connections have been closed.
+    @rtype: bool
+    """
+    for session in (conn._session, getattr(conn, '_scp_session', None)):
+        if isinstance(session, manager.Manager):
+            if not session.connected:
+                return False
+        elif isinstance(session, paramiko.SSHClient):
+            transport = session.get_transport()
+            if transport is None or not transport.is_active():
+                return False
+    return not (conn._shell and conn._shell.closed)
+
+
+def socket_path():
+    """ Return the filepath of the daemon's Unix domain socket.
+
+    @returns: The JAIDE_SOCKET environment variable if it is set, otherwise
+            | '.jaide.sock' in the user's home directory.
+    @rtype: str
+    """
+    return os.environ.get('JAIDE_SOCKET',
+                          path.join(path.expanduser('~'), '.jaide.sock'))
+
+
+class SessionPool(object):
+
+    """ A thread-safe store of open Jaide sessions.
+
+    Sessions are keyed by (host, port, username). Each key has its own
+    re-entrant lock, so one device's session is only ever used by a single
+    command at a time, while different devices are worked in parallel.
+    Sessions that sit unused for idle_timeout seconds, or that have been open
+    for longer than max_age seconds, are closed by reap().
+    """
+
+    def __init__(self, idle_timeout=300, max_age=3600):
+        """ Initialize the SessionPool object.
+
+        @param idle_timeout: Seconds a session may go unused before it is
+                           | closed.
+        @type idle_timeout: int
+        @param max_age: Seconds a session may stay open in total before it
+                      | is closed, regardless of use.
+        @type max_age: int
+        """
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self._sessions = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def _key_lock(self, key):
+        """ Return the lock guarding the session for key. """
+        with self._lock:
+            return self._locks.setdefault(key, threading.RLock())
+
+    def _evict(self, key):
+        """ Remove the session for key, and close it if it exists. """
+        with self._lock:
+            session = self._sessions.pop(key, None)
+        if session is not None:
+            try:
+                session['jaide'].disconnect()
+            except Exception:
+                # The session is being thrown away, likely because it is
+                # already broken, so there is nothing more to do with it.
+                pass
+
+    def run(self, function, args, host, username, password, port=22,
+            connect_timeout=5, session_timeout=300):
+        """ Run a jaide.wrap function against a pooled session.
+
+        Purpose: Reuses the open session for (host, port, username) if there
+               | is one and its connections are still up, otherwise opens a
+               | new one. The function is only ever run once. If the session
+               | breaks while it runs, the session is evicted and the error
+               | is raised to the caller, rather than running the function
+               | again, as a commit or push could already have gone through.
+               | Connection errors while opening a session are also raised.
+
+        @param function: The downstream jaide.wrap function to run.
+        @type function: function pointer.
+        @param args: The arguments to hand off to the downstream function.
+        @type args: list
+        @param host: The IP or hostname of the device.
+        @type host: str
+        @param username: The username for the connection.
+        @type username: str
+        @param password: The password for the connection. A cached session
+                       | is only reused if it was opened with the same one.
+        @type password: str
+        @param port: The destination port on the device.
+        @type port: int
+        @param connect_timeout: The connection timeout, in seconds.
+        @type connect_timeout: int
+        @param session_timeout: The session timeout, in seconds.
+        @type session_timeout: int
+
+        @returns: The output of the downstream function.
+        @rtype: str
+        """
+        key = (host, port, username)
+        with self._key_lock(key):
+            session = self._sessions.get(key)
+            if (session is not None and session['password'] == password and
+                    _is_alive(session['jaide'])):
+                session['used'] = time.time()
+                conn = session['jaide']
+                conn.connect_timeout = connect_timeout
+                conn.session_timeout = session_timeout
+            else:
+                self._evict(key)
+                conn = Jaide(host, username, password,
+                             connect_timeout=connect_timeout,
+                             session_timeout=session_timeout, port=port)
+                now = time.time()
+                with self._lock:
+                    self._sessions[key] = {
+                        "jaide": conn,
+                        "password": password,
+                        "created": now,
+                        "used": now
+                    }
+            try:
+                return function(conn, *args)
+            except BROKEN_ERRORS:
+                self._evict(key)
+                raise
+
+    def reap(self):
+        """ Close sessions that have been idle or open for too long.
+
+        Sessions that are in use at the time are skipped, and will be
+        checked again on the next pass.
+        """
+        now = time.time()
+        with self._lock:
+            keys = list(self._sessions)
+        for key in keys:
+            lock = self._key_lock(key)
+            if not lock.acquire(False):
+                continue
+            try:
+                session = self._sessions.get(key)
+                if session is not None and (
+                        now - session['used'] > self.idle_timeout or
+                        now - session['created'] > self.max_age):
+                    self._evict(key)
+            finally:
+                lock.release()
+
+    def start_reaper(self, interval=30):
+        """ Start a background thread calling reap() every interval seconds.
+
+        @param interval: Seconds between each pass of the reaper.
+        @type interval: int
+
+        @returns: The started reaper thread.
+        @rtype: threading.Thread
+        """
+        def reaper():
+            while not self._stopped.wait(interval):
+                self.reap()
+        thread = threading.Thread(target=reaper, name='jaide-reaper')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def close_all(self):
+        """ Stop the reaper, and close every session in the pool. """
+        self._stopped.set()
+        with self._lock:
+            keys = list(self._sessions)
+        for key in keys:
+            with self._key_lock(key):
+                self._evict(key)
+
+
+class _Output(object):
+
+    """ File-like wrapper streaming a request's output back to the client.
+
+    isatty() reports whether the client's own stdout is a terminal, so that
+    click keeps or strips the color codes just as it would have locally.
+    Writes after the client has gone away are silently dropped.
+    """
+
+    def __init__(self, wfile, tty=False):
+        self._wfile = wfile
+        self._tty = tty
+        self.closed = False
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        try:
+            self._wfile.write(data)
+        except socket.error:
+            self.closed = True
+
+    def flush(self):
+        try:
+            self._wfile.flush()
+        except socket.error:
+            self.closed = True
+
+    def isatty(self):
+        return self._tty
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+
+    """ Read one JSON request from the client, and hand it to the server. """
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line.strip():  # forward() checking that we're listening.
+            return
+        request = json.loads(line)
+        out = _Output(self.wfile, request.get('tty', False))
+        status = self.server.callback(request, out)
+        out.write('%s%d\n' % (STATUS_MARK, status))
+
+
+def serve(callback, sock_path):
+    """ Listen on a Unix domain socket and handle forwarded requests.
+
+    Purpose: Requests are handled one at a time, in the order they arrive.
+           | Each request fans out to its devices in parallel on its own, so
+           | this keeps two requests from fighting over the same sessions
+           | or interleaving their output. The socket is only accessible to
+           | the user running the daemon, and is removed on the way out.
+
+    @param callback: Called with the decoded request dictionary and a
+                   | file-like object to write the output to. Returns the
+                   | exit status of the command.
+    @type callback: function pointer.
+    @param sock_path: The filepath to create the socket at.
+    @type sock_path: str
+
+    @returns: None. Blocks until interrupted.
+    """
+    if path.exists(sock_path):
+        try:
+            connect(sock_path).close()
+        except socket.error:
+            # nobody is listening, so it is left over from a dead daemon.
+            os.remove(sock_path)
+        else:
+            raise socket.error('A jaide daemon is already listening on %s' %
+                               sock_path)
+    old_umask = os.umask(0o177)
+    try:
+        server = SocketServer.UnixStreamServer(sock_path, _RequestHandler)
+    finally:
+        os.umask(old_umask)
+    server.callback = callback
+    # make sure a plain 'kill' still cleans up the socket on the way out.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(sock_path)
+
+
+def connect(sock_path):
+    """ Open a connection to the daemon.
+
+    @param sock_path: The filepath of the daemon's socket.
+    @type sock_path: str
+
+    @returns: The connected socket. Raises socket.error if the daemon can't
+            | be reached.
+    @rtype: socket.socket
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(sock_path)
+    except socket.error:
+        client.close()
+        raise
+    return client
+
+
+def forward(request, client, out):
+    """ Send a request to the daemon, and stream the output it sends back.
+
+    @param request: The request to forward.
+    @type request: dict
+    @param client: The socket returned by connect(). It is closed once the
+                 | daemon is done with the request.
+    @type client: socket.socket
+    @param out: The file-like object to write the output to.
+    @type out: file
+
+    @returns: The exit status of the command. Raises socket.error if the
+            | connection is lost before the daemon sends it.
+    @rtype: int
+    """
+    held = ''
+    try:
+        client.sendall(json.dumps(request) + '\n')
+        while True:
+            data = client.recv(4096)
+            if not data:
+                break
+            # hold back anything from the last mark on, since it may be the
+            # start of the exit status.
+            data = held + data
+            mark = data.rfind(STATUS_MARK)
+            if mark == -1:
+                mark = len(data)
+            data, held = data[:mark], data[mark:]
+            if data:
+                out.write(data)
+                out.flush()
+    finally:
+        client.close()
+    status = held[len(STATUS_MARK):]
+    if status.endswith('\n') and status[:-1].isdigit():
+        return int(status)
+    out.write(held)
+    raise socket.error('The daemon closed the connection before the command '
+                       'finished.')
@@ -30,7 +30,7 @@ import click
 
 # TODO: [2.1] @rfe make this a decorator function, handing the Jaide object downstream?
 def open_connection(ip, username, password, function, args, write=False,
-                    conn_timeout=5, sess_timeout=300, port=22):
+                    conn_timeout=5, sess_timeout=300, port=22, pool=None):
     """ Open a Jaide session with the device.
 
     To open a Jaide session to the device, and run the appropriate function
@@ -64,22 +64,34 @@ def open_connection(ip, username, password, function, args, write=False,
     @type sess_timeout: int
     @param port: The port to connect to the device on. Defaults to 22.
     @type port: int
+    @param pool: If set, an already open session to the device is reused
+               | from the pool instead of connecting from scratch. Used by
+               | the 'jaide serve' daemon.
+    @type pool: jaide.server.SessionPool
 
     @returns: We could return either just a string of the output from the
             | device, or a tuple containing the information needed to write
-            | to a file and the string output from the device.
+            | to a file, the IP or hostname of the device, and the string
+            | output from the device.
     @rtype: Tuple or str
     """
     # start with the header line on the output.
-    output = color('=' * 50 + '\nResults from device: %s\n' % ip, 'yel')
+    output = color('=' * 50 + '\nResults from device: %s\n\n' % ip, 'yel')
     try:
-        # create the Jaide session object for the device.
-        conn = Jaide(ip, username, password, connect_timeout=conn_timeout,
-                     session_timeout=sess_timeout, port=port)
+        if pool is not None:
+            # reuse (or open and keep) the session held by the daemon.
+            output += pool.run(function, args, ip, username, password, port,
+                               connect_timeout=conn_timeout,
+                               session_timeout=sess_timeout)
+        else:
+            # create the Jaide session object for the device.
+            conn = Jaide(ip, username, password, connect_timeout=conn_timeout,
+                         session_timeout=sess_timeout, port=port)
+            output += function(conn, *args)
         if write is not False:
-            return write, output + function(conn, *args)
+            return write, ip, output
         else:
-            return output + function(conn, *args)
+            return output
     except errors.SSHError:
         output += color('Unable to connect to port %s on device: %s\n' %
                         (str(port), ip), 'red')
@@ -98,7 +110,7 @@ def open_connection(ip, username, password, function, args, write=False,
         output += color('The device refused the connection on port %s, or '
                         'no route to host.' % port, 'red')
     if write is not False:
-        return write, output
+        return write, ip, output
     else:
         return output
 